@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from profiling import current_profile
+
+# --- PROCESS-WIDE UPSTREAM LIMITS ---
+# Max concurrent calls we allow against each external service.
+# Overpass rate-limits hardest (429s), so it gets the smallest budget.
+UPSTREAM_LIMITS = {
+    "overpass": 2,
+    "stac": 4,       # Planetary Computer STAC search + COG reads
+    "gee": 4,        # Google Earth Engine getInfo() calls
+    "open_meteo": 4
+}
+# Admission keeps each upstream's admitted demand within ADMISSION_HEADROOM x
+# its slots, so a caller waits for at most about one in-flight call (Open-Meteo's
+# 15 s timeout is the longest). Running out of this means the upstream is stuck.
+UPSTREAM_WAIT_SECONDS = 15
+ADMISSION_HEADROOM = 2
+
+# Peak upstream slots one request of each route holds at the same time
+ROUTE_DEMAND = {
+    "analyze": {"stac": 2, "overpass": 2},       # LULC + Sentinel-2, urban + water checks
+    "analyze_area": {"stac": 3, "overpass": 2},  # LULC / B04 / B08 windows, urban + water checks
+    "map_overlay": {"gee": 1},
+    "predict_risk": {"open_meteo": 1},
+    "dashboard": {"gee": 2, "open_meteo": 1},    # Live NDVI + NPP fetched in parallel
+}
+
+# One shared, bounded pool for all upstream fan-out (replaces per-request pools)
+SHARED_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="upstream")
+
+# Lower number = served first
+PRIORITY = {"interactive": 0, "dashboard": 1, "batch": 2}
+
+
+RETRY_AFTER_SECONDS = 5
+
+
+class UpstreamBusy(Exception):
+    """
+    Raised when no slot for an upstream frees up within the wait budget.
+    Fetchers let it propagate; routes turn it into a 503 via busy_error().
+    """
+    pass
+
+
+def busy_error(detail, retry_after=RETRY_AFTER_SECONDS):
+    """The fast-rejection response: 503 + Retry-After."""
+    return HTTPException(
+        status_code=503,
+        detail=f"{detail} Please retry in {retry_after}s.",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+class UpstreamLimiter:
+    def __init__(self, limits=UPSTREAM_LIMITS, wait_seconds=UPSTREAM_WAIT_SECONDS):
+        self.wait_seconds = wait_seconds
+        self.semaphores = {name: threading.BoundedSemaphore(n) for name, n in limits.items()}
+
+    @contextmanager
+    def slot(self, upstream):
+        """
+        Holds one concurrency slot for `upstream` while the block runs.
+        Raises UpstreamBusy instead of queueing forever.
+        """
+        sem = self.semaphores[upstream]
+        requested = time.perf_counter()
+        if not sem.acquire(timeout=self.wait_seconds):
+            print(f"🚦 {upstream} saturated. Skipping call.")
+            raise UpstreamBusy(upstream)
+        acquired = time.perf_counter()
+        try:
+            yield
+        finally:
+            sem.release()
+            # Attribute queue wait vs. call time to the request's profile
+            profile = current_profile.get()
+            if profile is not None:
+                profile.record_upstream(upstream, acquired - requested, time.perf_counter() - acquired)
+
+
+class AdmissionController:
+    """
+    Caps how many requests run at once and queues the rest by priority.
+    A request is only admitted once its route's upstream demand
+    (ROUTE_DEMAND) fits the upstream budgets, so overload queues here
+    rather than failing mid-request with UpstreamBusy.
+    When a priority's queue is full, requests are shed with a fast 503.
+    """
+    def __init__(self, max_active=8, max_queued=None, retry_after=RETRY_AFTER_SECONDS,
+                 limits=UPSTREAM_LIMITS, headroom=ADMISSION_HEADROOM):
+        self.max_active = max_active
+        self.retry_after = retry_after
+        # Per-priority queue depth. Interactive work gets the deepest queue.
+        self.max_queued = max_queued or {"interactive": 32, "dashboard": 16, "batch": 8}
+        self.budget = {name: n * headroom for name, n in limits.items()}
+        self.reserved = {name: 0 for name in limits}
+        self.active = 0
+        self.waiting = []  # heap of (priority, seq, future, kind, demand)
+        self.queued = {kind: 0 for kind in PRIORITY}
+        self._seq = itertools.count()
+
+    def _shed(self, kind):
+        print(f"⛔ LOAD SHED: {kind} queue full ({self.queued[kind]} waiting).")
+        raise busy_error("Server busy.", self.retry_after)
+
+    def _fits(self, demand):
+        return self.active < self.max_active and all(
+            self.reserved[upstream] + n <= self.budget[upstream] for upstream, n in demand.items()
+        )
+
+    def _take(self, demand):
+        self.active += 1
+        for upstream, n in demand.items():
+            self.reserved[upstream] += n
+
+    def _release(self, demand):
+        self.active -= 1
+        for upstream, n in demand.items():
+            self.reserved[upstream] -= n
+        self._wake_next()
+
+    def _drop_waiter(self, future, kind):
+        # Remove a cancelled entry now so it doesn't hold a queue position.
+        # _wake_next may already have dropped (and uncounted) it.
+        remaining = [w for w in self.waiting if w[2] is not future]
+        if len(remaining) < len(self.waiting):
+            self.queued[kind] -= 1
+        self.waiting = remaining
+        heapq.heapify(self.waiting)
+        self._wake_next()
+
+    def _wake_next(self):
+        # Admit waiters in priority order while they fit. One that doesn't fit
+        # claims its upstreams: lower-priority work may only pass it on
+        # upstreams it doesn't need, so it can't be starved.
+        blocked, still_waiting = set(), []
+        for entry in sorted(self.waiting):
+            _, _, future, kind, demand = entry
+            if future.done():  # Cancelled while queued
+                self.queued[kind] -= 1
+            elif self._fits(demand) and not blocked & demand.keys():
+                self.queued[kind] -= 1
+                self._take(demand)
+                future.set_result(True)
+            else:
+                blocked.update(demand)
+                still_waiting.append(entry)
+        self.waiting = still_waiting  # A sorted list is a valid heap
+
+    def shed_if_full(self, kind, route=None):
+        """
+        Raises the 503 now if admit(kind, route) would shed right now (same
+        test). For streaming routes, which must reject before the response
+        starts but admit inside it.
+        """
+        must_queue = not self._fits(ROUTE_DEMAND.get(route, {})) or self.waiting
+        if must_queue and self.queued[kind] >= self.max_queued[kind]:
+            self._shed(kind)
+
+    @asynccontextmanager
+    async def admit(self, kind="interactive", route=None):
+        """Holds an admission slot (plus `route`'s upstream demand) for the block."""
+        demand = ROUTE_DEMAND.get(route, {})
+        if self._fits(demand) and not self.waiting:
+            self._take(demand)
+        else:
+            if self.queued[kind] >= self.max_queued[kind]:
+                self._shed(kind)
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (PRIORITY[kind], next(self._seq), future, kind, demand))
+            self.queued[kind] += 1
+            self._wake_next()  # May pass blocked waiters on other upstreams
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Client went away while queued. Pass the slot on if we already
+                # got one, otherwise give up our place in the queue.
+                if future.done() and not future.cancelled():
+                    self._release(demand)
+                else:
+                    self._drop_waiter(future, kind)
+                raise
+        try:
+            yield
+        finally:
+            self._release(demand)
+
+
+# Shared instances used by main.py and the stage engines
+upstream_limiter = UpstreamLimiter()
+admission = AdmissionController()
@@ -0,0 +1,170 @@
+import gzip
+import json
+from fastapi import HTTPException, Response
+
+# --- OPTIONAL FAST PATHS (each falls back gracefully if not installed) ---
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Media types offered via the Accept header (or ?format=)
+COLUMNAR_JSON = "application/vnd.agriq.columnar+json"
+MSGPACK = "application/x-msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+FORMATS = {"json": "application/json", "columnar": COLUMNAR_JSON, "msgpack": MSGPACK, "arrow": ARROW}
+
+MIN_COMPRESS_BYTES = 1024  # Not worth compressing tiny payloads
+
+# Per-row fields that are the same for every point (sent once, not per month)
+CONSTANT_KEYS = ("temp_limit",)
+
+
+def _available(media):
+    # Binary forms need their optional libraries
+    return not ((media == MSGPACK and msgpack is None) or (media == ARROW and pa is None))
+
+
+def _accepted(accept):
+    """Values from an Accept / Accept-Encoding header, best q first; q=0 means 'not this'."""
+    ranked = []
+    for position, part in enumerate(accept.split(",")):
+        media, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media and q > 0:
+            ranked.append((-q, position, media.lower()))
+    return [media for _, _, media in sorted(ranked)]
+
+
+def has_series(payload):
+    graph = payload.get("time_series_graph") if isinstance(payload, dict) else None
+    return bool(graph and graph.get("data_points"))
+
+
+def negotiate(request, payload=None):
+    """
+    Picks the response media type from ?format= or the Accept header.
+    An explicit ?format= that is unknown or not installed gets a 406.
+    Columnar / Arrow are only used when the payload has data points.
+    """
+    requested = request.query_params.get("format")
+    if requested is not None:
+        media = FORMATS.get(requested)
+        if media is None or not _available(media):
+            offered = [name for name, m in FORMATS.items() if _available(m)]
+            raise HTTPException(status_code=406, detail=f"Format '{requested}' not available. Options: {offered}")
+    else:
+        offered = set(FORMATS.values())
+        accepted = _accepted(request.headers.get("accept", ""))
+        media = next((m for m in accepted if m in offered and _available(m)), "application/json")
+
+    if media in (COLUMNAR_JSON, ARROW) and payload is not None and not has_series(payload):
+        media = "application/json"
+    return media
+
+
+def to_columnar(report):
+    """
+    Rewrites `time_series_graph.data_points` (list of per-month dicts) as
+    parallel arrays, hoisting CONSTANT_KEYS (e.g. temp_limit) to scalars.
+    """
+    if not has_series(report):
+        return report
+
+    graph = report["time_series_graph"]
+    points = graph["data_points"]
+    keys = list(points[0].keys())
+    columns, constants = {}, {}
+    for key in keys:
+        if key in CONSTANT_KEYS:
+            constants[key] = points[0][key]
+        else:
+            columns[key] = [p[key] for p in points]
+
+    compact = {k: v for k, v in graph.items() if k != "data_points"}
+    compact.update({"length": len(points), "constants": constants, "columns": columns})
+    return {**report, "time_series_graph": compact}
+
+
+def _dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(payload, separators=(",", ":"), default=float).encode()
+
+
+def _to_arrow(payload):
+    # Time-series columns become the Arrow table; everything else rides along
+    # as JSON in the schema metadata so the client still gets the full report.
+    graph = payload["time_series_graph"]
+    table = pa.table(graph["columns"])
+    meta = {k: v for k, v in payload.items() if k != "time_series_graph"}
+    meta["time_series_graph"] = {k: v for k, v in graph.items() if k != "columns"}
+    table = table.replace_schema_metadata({"report": _dumps(meta)})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _compress(body, request):
+    """Compresses with the client's best-ranked coding we support (q=0 excluded)."""
+    if len(body) < MIN_COMPRESS_BYTES:
+        return body, None
+    header = request.headers.get("accept-encoding", "")
+    accepted = _accepted(header)
+    named = {part.split(";")[0].strip().lower() for part in header.split(",")}
+    supported = (["br"] if brotli is not None else []) + ["gzip"]
+    for coding in accepted:
+        if coding == "*":  # Anything not named explicitly
+            coding = next((c for c in supported if c not in named), None)
+        if coding == "br" and brotli is not None:
+            return brotli.compress(body, quality=5), "br"
+        if coding in ("gzip", "x-gzip"):
+            return gzip.compress(body, compresslevel=6), "gzip"
+        if coding == "identity":
+            break
+    return body, None
+
+
+def sse_event(event, payload):
+    """One Server-Sent Events frame: `event: <name>` + JSON `data:` line."""
+    return b"event: " + event.encode() + b"\ndata: " + _dumps(payload) + b"\n\n"
+
+
+def render(payload, request):
+    """Serializes `payload` in the negotiated format and compresses it."""
+    media = negotiate(request, payload)
+    if media != "application/json":
+        payload = to_columnar(payload)
+
+    if media == MSGPACK:
+        body = msgpack.packb(payload, use_bin_type=True)
+    elif media == ARROW:
+        body = _to_arrow(payload)
+    else:
+        body = _dumps(payload)
+
+    body, content_encoding = _compress(body, request)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return Response(content=body, media_type=media, headers=headers)
@@ -1,22 +1,30 @@
 import json
 import os
+import threading
 from datetime import datetime
 
 class HistoryManager:
     def __init__(self, filename="site_audit_log.json"):
         self.filename = filename
+        # Routes now run in a threadpool, so guard the read-modify-write
+        self.lock = threading.Lock()
         # Initialize file if it doesn't exist
         if not os.path.exists(self.filename):
             with open(self.filename, 'w') as f:
                 json.dump({}, f)
 
-    def log_audit(self, lat, lon, species, data):
+    def log_audit(self, lat, lon, species, data, simulated=False):
         """
         Saves the 'Continuous Health Audit' to a permanent JSON log.
         Fulfills: "Track land-health indicators over time"
+        `simulated` marks snapshots taken under the drought simulation.
         """
         site_key = f"{lat}_{lon}_{species}"
         
+        with self.lock:
+            self._append_snapshot(site_key, data, simulated)
+
+    def _append_snapshot(self, site_key, data, simulated):
         try:
             with open(self.filename, 'r') as f:
                 history = json.load(f)
@@ -31,7 +39,8 @@ class HistoryManager:
             "timestamp": datetime.now().isoformat(),
             "vegetation_density_ndvi": data['health_analytics']['current_ndvi'],
             "restoration_velocity_rpi": data['health_analytics']['restoration_index'],
-            "carbon_stored_kg": data['carbon_trajectory'][-1]['stored_kg']
+            "carbon_stored_kg": data['carbon_trajectory'][-1]['stored_kg'],
+            "drought_simulation": simulated
         }
         
         history[site_key].append(snapshot)
@@ -42,6 +51,6 @@ class HistoryManager:
     def get_history(self, lat, lon, species):
         """Returns the full timeline for frontend charts"""
         site_key = f"{lat}_{lon}_{species}"
-        with open(self.filename, 'r') as f:
+        with self.lock, open(self.filename, 'r') as f:
             history = json.load(f)
         return history.get(site_key, [])
\ No newline at end of file
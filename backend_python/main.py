@@ -1,5 +1,9 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import threading
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 import uvicorn
 
 # --- IMPORT ENGINES ---
@@ -7,6 +11,9 @@ from stage1 import SiteScouterV2
 from stage3 import EarlyWarningSystem
 from stage4 import GEEImpactEngine
 from overlay import IndiaOverlayEngine  # Importing your new overlay logic
+from admission import admission, busy_error, UpstreamBusy  # Process-wide admission control & load shedding
+from profiling import attached, current_profile, start_profile
+from encoding import negotiate, render, sse_event  # Content negotiation: JSON / columnar / msgpack / Arrow
 
 app = FastAPI(title="AgriQCert: Adaptive Reforestation Platform")
 
@@ -19,6 +26,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- ON-DEMAND PROFILING (?profile=<PROFILE_TOKEN> / X-Profile / PROFILE_ONE_IN_N) ---
+class ProfileMiddleware:
+    """
+    Pure ASGI, so `receive` reaches the routes untouched and
+    request.is_disconnected() still sees http.disconnect.
+    Sampling runs until the last body chunk (e.g. of the SSE stream) is sent.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profile = start_profile(Request(scope)) if scope["type"] == "http" else None
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        async def send_profiled(message):
+            if message["type"] == "http.response.start":
+                headers = [*message.get("headers", []), (b"x-profile-id", profile.profile_id.encode())]
+                message = {**message, "headers": headers}
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                # Stop sampling here; saving waits until the app returns, since
+                # a streaming response is cancelled right after its last chunk
+                profile.stop()
+
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            current_profile.reset(token)
+            profile.stop()  # No-op unless it errored or the client left mid-body
+            await run_in_threadpool(profile.save)
+
+app.add_middleware(ProfileMiddleware)
+
+# --- CLIENT DISCONNECT -> CANCEL IN-FLIGHT WORK ---
+async def run_until_disconnect(request: Request, fn, *args):
+    """
+    Runs blocking `fn(*args, cancel=Event)` in the threadpool and sets the
+    event if the client goes away, so upstream fetches stop early.
+    """
+    cancel = threading.Event()
+    work = asyncio.ensure_future(run_in_threadpool(attached(fn), *args, cancel=cancel))
+    while not work.done():
+        await asyncio.wait({work}, timeout=0.25)
+        if not work.done() and await request.is_disconnected():
+            print("🔌 Client disconnected. Cancelling in-flight work.")
+            cancel.set()
+            break
+    return await work
+
 # --- INITIALIZE ENGINES ---
 print("--- 🟢 SYSTEM STARTUP: Initializing Engines ---")
 scout = SiteScouterV2()
@@ -38,6 +96,10 @@ async def map_route():
     Returns a dynamic Tile URL for Leaflet to overlay the 
     'Reforestation Opportunity' heatmap across India.
     """
+    async with admission.admit("dashboard", "map_overlay"):
+        return await run_in_threadpool(attached(_map_route))
+
+def _map_route():
     try:
         tile_url = overlay_engine.get_suitability_tile_url()
         if not tile_url:
@@ -48,6 +110,8 @@ async def map_route():
             "tile_url": tile_url,
             "attribution": "Google Earth Engine | AgriQCert"
         }
+    except UpstreamBusy as e:
+        raise busy_error(f"Upstream '{e}' is saturated.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -56,9 +120,14 @@ async def map_route():
 # 1. EXISTING ROUTE: STAGE 1 (Site Scouting)
 # ==========================================
 @app.get("/analyze/{lat}/{lon}")
-async def analyze_get(lat: float, lon: float, name: str = "Query Point"):
+async def analyze_get(request: Request, lat: float, lon: float, name: str = "Query Point"):
+    # Interactive map clicks jump the queue ahead of batch/dashboard work
+    async with admission.admit("interactive", "analyze"):
+        return await run_until_disconnect(request, _analyze_get, lat, lon, name)
+
+def _analyze_get(lat, lon, name, cancel=None):
     try:
-        ssi_score = scout.analyze_site(lat, lon, name)
+        ssi_score = scout.analyze_site(lat, lon, name, cancel=cancel)
         
         if ssi_score is None:
             raise HTTPException(status_code=404, detail="Analysis failed for these coordinates.")
@@ -71,20 +140,73 @@ async def analyze_get(lat: float, lon: float, name: str = "Query Point"):
             "status": "Success",
             "message": "Analysis completed using original SiteScouter logic"
         }
+    except UpstreamBusy as e:
+        raise busy_error(f"Upstream '{e}' is saturated.")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# ==========================================
+# 1b. NEW ROUTE: STAGE 1 RASTER MODE (Pixel-level SSI for a plot)
+# ==========================================
+MAX_BBOX_DEG = 0.05  # ~5.5 km per side; keeps the windowed reads bounded
+
+@app.get("/analyze-area")
+async def analyze_area(
+    min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+    output: str = "summary", top_k: int = Query(10, ge=0, le=100)
+):
+    """
+    Scores every ~10 m pixel in the bounding box in one windowed read.
+    output = summary (JSON stats + top-k pixels) | geotiff | png
+    """
+    if not (min_lat < max_lat and min_lon < max_lon):
+        raise HTTPException(status_code=400, detail="Invalid bounding box.")
+    if max_lat - min_lat > MAX_BBOX_DEG or max_lon - min_lon > MAX_BBOX_DEG:
+        raise HTTPException(status_code=400, detail=f"Bounding box too large (max {MAX_BBOX_DEG}° per side).")
+    if output not in ("summary", "geotiff", "png"):
+        raise HTTPException(status_code=400, detail="output must be summary, geotiff or png.")
+
+    async with admission.admit("interactive", "analyze_area"):
+        return await run_in_threadpool(
+            attached(_analyze_area), (min_lon, min_lat, max_lon, max_lat), output, top_k
+        )
+
+def _analyze_area(bbox, output, top_k):
+    try:
+        result = scout.analyze_bbox(bbox, output=output, top_k=top_k)
+    except UpstreamBusy as e:
+        raise busy_error(f"Upstream '{e}' is saturated.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if result is None:
+        raise HTTPException(status_code=404, detail="Raster analysis failed for this area.")
+    if output == "geotiff":
+        return Response(content=result, media_type="image/tiff")
+    if output == "png":
+        return Response(content=result, media_type="image/png")
+    return {"status": "Success", **result}
+
 
 # ==========================================
 # 2. EXISTING ROUTE: STAGE 3 (Weather Risk)
 # ==========================================
 @app.get("/predict-risk")
-async def predict_risk(lat: float, lon: float, species: str):
+async def predict_risk(request: Request, lat: float, lon: float, species: str):
+    negotiate(request)  # 406 before any upstream work if the format is unavailable
+    async with admission.admit("batch", "predict_risk"):
+        report = await run_in_threadpool(attached(_predict_risk), lat, lon, species)
+    return render(report, request)
+
+def _predict_risk(lat, lon, species):
     try:
         report = ews.analyze_everything(lat, lon, species)
         if not report:
             raise HTTPException(status_code=500, detail="Weather data fetch failed or Species not found.")
         return report
+    except UpstreamBusy as e:
+        raise busy_error(f"Upstream '{e}' is saturated.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -94,6 +216,7 @@ async def predict_risk(lat: float, lon: float, species: str):
 # ==========================================
 @app.get("/continuous-analytics")
 async def get_dashboard_metrics(
+    request: Request,
     lat: float, 
     lon: float, 
     species: str, 
@@ -101,6 +224,14 @@ async def get_dashboard_metrics(
     current_ndvi: float = None,
     simulate_drought: bool = False
 ):
+    negotiate(request)
+    async with admission.admit("dashboard", "dashboard"):
+        metrics = await run_in_threadpool(
+            attached(_dashboard_metrics), lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought
+        )
+    return render(metrics, request)
+
+def _dashboard_metrics(lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought):
     try:
         print(f"\n📊 DASHBOARD REQUEST: {species} @ {lat},{lon} | Drought Sim: {simulate_drought}")
 
@@ -109,16 +240,10 @@ async def get_dashboard_metrics(
             current_ndvi = gee_engine.get_live_ndvi(lat, lon)
 
         risk_report = ews.analyze_everything(lat, lon, species)
-        
-        if not risk_report:
-            survival_prob = 0.85 
-        else:
-            survival_prob = risk_report['long_term']['survival_probability_3yr']
+        survival_prob = _survival_probability(risk_report, simulate_drought)
 
         if simulate_drought:
-            survival_prob = survival_prob * 0.6
             current_ndvi = current_ndvi * 0.85 
-            print("⚠️ DROUGHT SIMULATION APPLIED.")
 
         audit_result = gee_engine.analyze_restoration_trend(
             species=species,
@@ -126,7 +251,8 @@ async def get_dashboard_metrics(
             baseline_ndvi=baseline_ndvi,
             current_ndvi=current_ndvi,
             lat=lat,
-            lon=lon
+            lon=lon,
+            simulated=simulate_drought
         )
 
         return {
@@ -136,29 +262,174 @@ async def get_dashboard_metrics(
                 "ndvi_source": "Satellite (Sentinel-2)" if current_ndvi is not None else "Manual Override",
                 "simulation_active": simulate_drought
             },
-            "widget_growth_curve": {
-                "title": f"10-Year Carbon Sequestration Forecast ({species})",
-                "x_axis_labels": [f"Year {x['year']}" for x in audit_result['carbon_trajectory']],
-                "y_axis_data": [x['stored_kg'] for x in audit_result['carbon_trajectory']],
-                "total_potential": f"{audit_result['carbon_trajectory'][-1]['stored_kg']} kg"
-            },
-            "widget_health_badge": {
-                "status": audit_result['health_analytics']['status'],
-                "density_gain": audit_result['health_analytics']['density_gain'],
-                "current_ndvi_value": round(current_ndvi, 3),
-                "ui_color": "green" if audit_result['health_analytics']['status'] == "THRIVING" else "yellow"
-            },
-            "widget_audit_stamp": {
-                "verified_by": "Google Earth Engine",
-                "dataset": "MODIS & Sentinel-2",
-                "productivity_factor": audit_result['verified_audit']['productivity_factor'],
-                "growth_velocity_k": audit_result['verified_audit']['growth_velocity_k']
-            }
+            "widget_growth_curve": _growth_curve_widget(species, audit_result),
+            "widget_health_badge": _health_badge_widget(audit_result['health_analytics'], current_ndvi),
+            "widget_audit_stamp": _audit_stamp_widget(audit_result)
         }
 
+    except UpstreamBusy as e:
+        raise busy_error(f"Upstream '{e}' is saturated.")
     except Exception as e:
         print(f"❌ DASHBOARD ERROR: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- WIDGET BUILDERS (shared by the JSON and streaming dashboards) ---
+def _survival_probability(risk_report, simulate_drought):
+    if not risk_report:
+        survival_prob = 0.85 
+    else:
+        survival_prob = risk_report['long_term']['survival_probability_3yr']
+
+    if simulate_drought:
+        survival_prob = survival_prob * 0.6
+        print("⚠️ DROUGHT SIMULATION APPLIED.")
+    return survival_prob
+
+def _growth_curve_widget(species, audit_result):
+    return {
+        "title": f"10-Year Carbon Sequestration Forecast ({species})",
+        "x_axis_labels": [f"Year {x['year']}" for x in audit_result['carbon_trajectory']],
+        "y_axis_data": [x['stored_kg'] for x in audit_result['carbon_trajectory']],
+        "total_potential": f"{audit_result['carbon_trajectory'][-1]['stored_kg']} kg"
+    }
+
+def _health_badge_widget(health, current_ndvi):
+    return {
+        "status": health['status'],
+        "density_gain": health['density_gain'],
+        "current_ndvi_value": round(current_ndvi, 3),
+        "ui_color": "green" if health['status'] == "THRIVING" else "yellow"
+    }
+
+def _audit_stamp_widget(audit_result):
+    return {
+        "verified_by": "Google Earth Engine",
+        "dataset": "MODIS & Sentinel-2",
+        "productivity_factor": audit_result['verified_audit']['productivity_factor'],
+        "growth_velocity_k": audit_result['verified_audit']['growth_velocity_k']
+    }
+
+def _risk_summary_widget(risk_report, survival_prob):
+    long_term = (risk_report or {}).get('long_term', {})
+    return {
+        "survival_probability_3yr": round(survival_prob, 2),
+        "trend_status": (risk_report or {}).get('metadata', {}).get('trend_status', "UNKNOWN"),
+        "primary_threat": long_term.get('primary_threat', "Unknown"),
+        "average_annual_rainfall": long_term.get('average_annual_rainfall')
+    }
+
+
+# ==========================================
+# 3b. NEW ROUTE: STAGE 4 STREAMING (Server-Sent Events)
+# ==========================================
+@app.get("/continuous-analytics/stream")
+async def stream_dashboard_metrics(
+    request: Request,
+    lat: float, 
+    lon: float, 
+    species: str, 
+    baseline_ndvi: float = 0.2, 
+    current_ndvi: float = None,
+    simulate_drought: bool = False
+):
+    """
+    SSE variant of /continuous-analytics. Each widget is emitted as soon as
+    its inputs are ready: a provisional health badge from the audit history
+    first, then live widgets ("provisional": false) as the fetches land.
+    """
+    # Shed before the stream starts; the slot itself is held inside it
+    admission.shed_if_full("dashboard", "dashboard")
+    return StreamingResponse(
+        _dashboard_events(request, lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _dashboard_events(request, lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought):
+    try:
+        async with admission.admit("dashboard", "dashboard"):
+            async for event in _dashboard_widgets(request, lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought):
+                yield event
+    except HTTPException as e:
+        # Shed after the 200 headers went out (the queue filled up since
+        # shed_if_full), so report it in-band instead of breaking the stream
+        yield sse_event("error", {"status": e.status_code, "detail": e.detail, "retry_after": admission.retry_after})
+
+async def _dashboard_widgets(request, lat, lon, species, baseline_ndvi, current_ndvi, simulate_drought):
+    print(f"\n📡 DASHBOARD STREAM: {species} @ {lat},{lon} | Drought Sim: {simulate_drought}")
+    try:
+        yield sse_event("meta", {
+            "lat": lat,
+            "lon": lon,
+            "ndvi_source": "Manual Override" if current_ndvi is not None else "Satellite (Sentinel-2)",
+            "simulation_active": simulate_drought
+        })
+
+        # 0. PROVISIONAL: last audit snapshot from the same simulation mode
+        # (local JSON, no upstream calls). Stored NDVI already has any drought
+        # factor applied, so it is used as-is.
+        history = await run_in_threadpool(gee_engine.history.get_history, lat, lon, species)
+        history = [h for h in history if h.get('drought_simulation', False) == simulate_drought]
+        if history and current_ndvi is None:
+            last = history[-1]
+            ndvi = last['vegetation_density_ndvi']
+            health, _ = gee_engine.assess_health(baseline_ndvi, ndvi)
+            yield sse_event("widget_health_badge", {
+                **_health_badge_widget(health, ndvi), "provisional": True, "as_of": last['timestamp']
+            })
+
+        # 1. LIVE: NDVI, 3-year weather and NPP in parallel
+        jobs = {"risk": (ews.analyze_everything, species), "npp": (gee_engine.get_site_productivity,)}
+        if current_ndvi is None:
+            jobs["ndvi"] = (gee_engine.get_live_ndvi,)
+        else:
+            if simulate_drought: current_ndvi = current_ndvi * 0.85
+            health, _ = gee_engine.assess_health(baseline_ndvi, current_ndvi)
+            yield sse_event("widget_health_badge", {**_health_badge_widget(health, current_ndvi), "provisional": False})
+
+        tasks = {
+            asyncio.ensure_future(run_in_threadpool(attached(fn), lat, lon, *args)): name
+            for name, (fn, *args) in jobs.items()
+        }
+        results, pending = {}, set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+            if await request.is_disconnected():
+                print("🔌 Stream client disconnected.")
+                return
+            for task in done:
+                name = tasks[task]
+                results[name] = task.result()
+
+                if name == "ndvi":
+                    current_ndvi = results["ndvi"] * (0.85 if simulate_drought else 1.0)
+                    health, _ = gee_engine.assess_health(baseline_ndvi, current_ndvi)
+                    yield sse_event("widget_health_badge", {**_health_badge_widget(health, current_ndvi), "provisional": False})
+                elif name == "risk":
+                    survival_prob = _survival_probability(results["risk"], simulate_drought)
+                    yield sse_event("widget_risk_summary", _risk_summary_widget(results["risk"], survival_prob))
+
+        # 2. FINAL: trajectory needs everything above (NPP is reused, not refetched)
+        audit_result = await run_in_threadpool(
+            attached(gee_engine.analyze_restoration_trend),
+            species=species,
+            survival_prob=survival_prob,
+            baseline_ndvi=baseline_ndvi,
+            current_ndvi=current_ndvi,
+            lat=lat,
+            lon=lon,
+            gee_factor=results["npp"],
+            simulated=simulate_drought
+        )
+        yield sse_event("widget_audit_stamp", _audit_stamp_widget(audit_result))
+        yield sse_event("widget_growth_curve", _growth_curve_widget(species, audit_result))
+        yield sse_event("complete", {"status": "success"})
+
+    except UpstreamBusy as e:
+        yield sse_event("error", {"status": 503, "detail": f"Upstream '{e}' is saturated.", "retry_after": admission.retry_after})
+    except Exception as e:
+        print(f"❌ DASHBOARD STREAM ERROR: {str(e)}")
+        yield sse_event("error", {"status": 500, "detail": str(e)})
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -2,6 +2,7 @@ import ee
 import json
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from admission import UpstreamBusy, upstream_limiter
 
 class IndiaOverlayEngine:
     def __init__(self):
@@ -59,11 +60,14 @@ class IndiaOverlayEngine:
             }
 
             # 6. Generate the XYZ Tile URL template
-            map_id = suitability_mask.getMapId(vis_params)
+            with upstream_limiter.slot("gee"):
+                map_id = suitability_mask.getMapId(vis_params)
             
             print("🛰️ GEE: Dynamic MapID successfully generated for India.")
             return map_id['tile_fetcher'].url_format
 
+        except UpstreamBusy:
+            raise
         except Exception as e:
             print(f"❌ GEE Overlay Error: {e}")
             return None
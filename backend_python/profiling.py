@@ -0,0 +1,191 @@
+import os
+import sys
+import hmac
+import time
+import itertools
+import threading
+import functools
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+# --- SETTINGS ---
+# Opt in per request with `?profile=<PROFILE_TOKEN>` or `X-Profile: <PROFILE_TOKEN>`.
+# Explicit opt-in is disabled unless PROFILE_TOKEN is set on the server.
+# PROFILE_ONE_IN_N=100 additionally profiles 1 in every 100 requests (0 = off).
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_ONE_IN_N = int(os.environ.get("PROFILE_ONE_IN_N", "0"))
+MAX_CONCURRENT_PROFILES = int(os.environ.get("MAX_CONCURRENT_PROFILES", "2"))
+MAX_PROFILES_KEPT = int(os.environ.get("MAX_PROFILES_KEPT", "100"))  # Oldest are deleted
+SAMPLE_INTERVAL = 0.005  # 5 ms between stack samples
+
+# The profile (if any) belonging to the request being handled
+current_profile = ContextVar("current_profile", default=None)
+
+_request_counter = itertools.count(1)
+_profile_slots = threading.BoundedSemaphore(MAX_CONCURRENT_PROFILES)
+
+
+def should_profile(request):
+    """Explicit opt-in with the configured token, or the 1-in-N production sampler."""
+    flag = request.headers.get("x-profile") or request.query_params.get("profile")
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str
+    if flag and PROFILE_TOKEN and hmac.compare_digest(flag.encode(), PROFILE_TOKEN.encode()):
+        return True
+    return PROFILE_ONE_IN_N > 0 and next(_request_counter) % PROFILE_ONE_IN_N == 0
+
+
+def start_profile(request):
+    """
+    Returns a running SamplingProfiler for this request, or None if it
+    wasn't asked for or MAX_CONCURRENT_PROFILES are already running.
+    """
+    if not should_profile(request):
+        return None
+    if not _profile_slots.acquire(blocking=False):
+        print("🔬 Profile skipped: too many profiles in flight.")
+        return None
+    profile = SamplingProfiler(label=request.url.path)
+    profile.start()
+    return profile
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of every thread working on one request.
+    Threads join via attach() (see `attached` below), so the shared
+    executor's fan-out for this request is captured too.
+    """
+    def __init__(self, label="request", interval=SAMPLE_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.threads = set()
+        self.stacks = Counter()
+        self.upstream = defaultdict(lambda: {"calls": 0, "wait_s": 0.0, "call_s": 0.0})
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self.started_at = None
+        self.duration = 0.0
+        # Known up front so it can go in the response headers before the body
+        slug = label.strip("/").replace("/", "_") or "root"
+        self.profile_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{slug}"
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._sampler = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        self.duration = time.perf_counter() - self.started_at
+        _profile_slots.release()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for tid in self.threads:
+                    frame = frames.get(tid)
+                    if frame is not None:
+                        self.stacks[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame):
+        # Root-first "module:function;..." (Brendan Gregg collapsed format)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            names.append(f"{module}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    @contextmanager
+    def attach(self):
+        """Samples the calling thread until the block exits."""
+        tid = threading.get_ident()
+        token = current_profile.set(self)
+        with self.lock:
+            self.threads.add(tid)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads.discard(tid)
+            current_profile.reset(token)
+
+    def record_upstream(self, upstream, wait_s, call_s):
+        with self.lock:
+            stats = self.upstream[upstream]
+            stats["calls"] += 1
+            stats["wait_s"] += wait_s
+            stats["call_s"] += call_s
+
+    def summary(self):
+        """Per-function self/total sample counts, heaviest first."""
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        return [(name, own[name], total[name]) for name, _ in total.most_common()]
+
+    def save(self, directory=PROFILE_DIR):
+        """Writes <id>.folded (flamegraph.pl / speedscope) and <id>.txt summary."""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.profile_id)
+
+        with open(base + ".folded", 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+        n_samples = sum(self.stacks.values()) or 1
+        with open(base + ".txt", 'w') as f:
+            f.write(f"Profile: {self.label}\n")
+            f.write(f"Wall time: {self.duration:.3f}s | Samples: {sum(self.stacks.values())} @ {self.interval * 1000:.0f}ms\n\n")
+            f.write("Upstream time (wait for slot / in call):\n")
+            for name, stats in sorted(self.upstream.items()):
+                f.write(f"  {name:<12} calls={stats['calls']:<3} wait={stats['wait_s']:.3f}s call={stats['call_s']:.3f}s\n")
+            f.write(f"\n{'self%':>7} {'total%':>7}  function\n")
+            for name, own, total in self.summary()[:60]:
+                f.write(f"{own / n_samples * 100:7.1f} {total / n_samples * 100:7.1f}  {name}\n")
+
+        print(f"🔬 PROFILE SAVED: {base}.folded ({self.duration:.2f}s)")
+        _prune_profiles(directory)
+        return self.profile_id
+
+
+def _prune_profiles(directory, keep=MAX_PROFILES_KEPT):
+    # Profile ids start with a timestamp, so name order is age order
+    ids = sorted({os.path.splitext(name)[0] for name in os.listdir(directory)
+                  if name.endswith((".folded", ".txt"))})
+    for profile_id in ids[:-keep] if keep else ids:
+        for ext in (".folded", ".txt"):
+            try:
+                os.remove(os.path.join(directory, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+
+def attached(fn):
+    """
+    Binds `fn` to the active request profile (if any), so whichever
+    thread ends up running it is sampled. No-op when not profiling.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return fn
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with profile.attach():
+            return fn(*args, **kwargs)
+    return run
@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight calls. The first caller for a key runs the
+    fetch; concurrent callers with the same key block and share its result
+    (or exception). Nothing is cached once the call completes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0  # How many upstream calls we avoided
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+                coalesced = self.coalesced
+
+        if not leader:
+            print(f"🔗 Joined in-flight {key[0]} call ({coalesced} upstream calls saved so far).")
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+def point_key(lat, lon, precision=5):
+    """Normalizes coordinates (~1 m) so float noise doesn't split a flight."""
+    return (round(float(lat), precision), round(float(lon), precision))
+
+
+# Shared instance used by the stage engines
+single_flight = SingleFlight()
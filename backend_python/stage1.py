@@ -4,10 +4,17 @@ import overpy
 from geopy.distance import geodesic
 import planetary_computer
 import warnings
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 import rasterio
 from rasterio.windows import from_bounds
-from rasterio.warp import transform_bounds
+from rasterio.warp import transform_bounds, Resampling
+from rasterio.transform import from_bounds as from_bounds_transform
+from rasterio.vrt import WarpedVRT
+from rasterio.io import MemoryFile
+from admission import SHARED_EXECUTOR, UpstreamBusy, upstream_limiter
+from profiling import attached
+from singleflight import single_flight, point_key
 
 warnings.filterwarnings("ignore")
 
@@ -31,9 +38,32 @@ class SiteScouterV2:
             100: ("Moss/Lichen", 40, 0.70)
         }
 
+    # --- SINGLE-FLIGHT UPSTREAM CALLS ---
+    # Identical concurrent STAC searches, COG reads and Overpass queries
+    # (e.g. several users opening the same site) share one upstream call.
+    def _search_items(self, collection, bbox, **search):
+        key = ("stac_search", collection, tuple(round(v, 6) for v in bbox), repr(sorted(search.items())))
+        return single_flight.do(key, self._run_search, collection, bbox, search)
+
+    def _run_search(self, collection, bbox, search):
+        with upstream_limiter.slot("stac"):
+            return list(self.catalog.search(collections=[collection], bbox=bbox, **search).items())
+
+    def _overpass(self, query):
+        return single_flight.do(("overpass", query), self._run_overpass, query)
+
+    def _run_overpass(self, query):
+        with upstream_limiter.slot("overpass"):
+            return self.osm_api.query(query)
+
     def _read_cog_window(self, href, lat, lon, buffer=0.002):
+        # Signed hrefs carry a per-search SAS token; key on the blob path only
+        key = ("cog", href.split("?")[0], *point_key(lat, lon), buffer)
+        return single_flight.do(key, self._read_cog_median, href, lat, lon, buffer)
+
+    def _read_cog_median(self, href, lat, lon, buffer):
         try:
-            with rasterio.open(href) as src:
+            with upstream_limiter.slot("stac"), rasterio.open(href) as src:
                 left, bottom, right, top = transform_bounds(
                     "EPSG:4326", src.crs, 
                     lon - buffer, lat - buffer, lon + buffer, lat + buffer
@@ -43,20 +73,21 @@ class SiteScouterV2:
                 valid = data[data > 0]
                 if len(valid) == 0: return None
                 return float(np.median(valid))
+        except UpstreamBusy:
+            raise  # Shed the request (503) rather than invent data
         except:
             return None
 
-    def fetch_sentinel2_direct(self, lat, lon):
+    def fetch_sentinel2_direct(self, lat, lon, stop=None):
         try:
             bbox = [lon - 0.005, lat - 0.005, lon + 0.005, lat + 0.005]
-            search = self.catalog.search(
-                collections=["sentinel-2-l2a"],
-                bbox=bbox,
+            items = self._search_items(
+                "sentinel-2-l2a",
+                bbox,
                 datetime="2024-01-01/2024-12-31",
                 query={"eo:cloud_cover": {"lt": 25}},
                 max_items=1
             )
-            items = list(search.items())
             if not items: return {"ndvi": 0.15, "ndwi": 0.0}
 
             item = items[0]
@@ -64,6 +95,8 @@ class SiteScouterV2:
             data_dict = {}
             
             for b in bands:
+                # Cooperative cancel: skip the COG reads once the outcome is known
+                if stop is not None and stop.is_set(): return None
                 href = item.assets[b].href
                 val = self._read_cog_window(href, lat, lon, buffer=0.001)
                 data_dict[b] = val if val else 1000 
@@ -73,14 +106,15 @@ class SiteScouterV2:
 
             ndvi = (nir - red) / (nir + red + 1e-8)
             return {"ndvi": float(ndvi), "ndwi": 0.05}
+        except UpstreamBusy:
+            raise
         except:
             return {"ndvi": 0.15, "ndwi": 0.0}
 
     def fetch_lulc_direct(self, lat, lon):
         try:
             bbox = [lon - 0.01, lat - 0.01, lon + 0.01, lat + 0.01]
-            search = self.catalog.search(collections=["esa-worldcover"], bbox=bbox)
-            items = list(search.items())
+            items = self._search_items("esa-worldcover", bbox)
             if not items: return None
             
             val = self._read_cog_window(items[0].assets["map"].href, lat, lon, buffer=0.001)
@@ -88,44 +122,102 @@ class SiteScouterV2:
             
             name, soil, suit = self.lulc_map.get(int(val), ("Unknown", 50, 0.5))
             return {"class": name, "soil_depth": soil, "suitability": suit}
+        except UpstreamBusy:
+            raise
         except: return None
 
     def fetch_water_osm(self, lat, lon):
         try:
             query = f'[out:json][timeout:3];(way["natural"="water"](around:3000,{lat},{lon});way["waterway"~"river|stream"](around:3000,{lat},{lon}););out center 1;'
-            result = self.osm_api.query(query)
+            result = self._overpass(query)
             if not result.ways: return 3000
             return int(geodesic((lat, lon), (result.ways[0].center_lat, result.ways[0].center_lon)).meters)
+        except UpstreamBusy:
+            raise
         except: return 3000
 
+    # The OSM urban check only looks this far around the point
+    URBAN_RADIUS_M = 500
+
     def is_urban_area(self, lat, lon):
         try:
-            query = f'[out:json][timeout:3];(way["highway"](around:500,{lat},{lon});way["building"](around:500,{lat},{lon}););out count;'
-            result = self.osm_api.query(query)
+            r = self.URBAN_RADIUS_M
+            query = f'[out:json][timeout:3];(way["highway"](around:{r},{lat},{lon});way["building"](around:{r},{lat},{lon}););out count;'
+            result = self._overpass(query)
             return len(result.ways) > 5  
+        except UpstreamBusy:
+            raise
         except:
             return False
 
-    def fetch_all_parallel(self, lat, lon):
+    # LULC classes that force SSI to ~0 (multiplied by 0.1) regardless of other layers
+    DECISIVE_CLASSES = ("Built-up", "Water Bodies")
+
+    def _decisive_result(self, results):
+        lulc = results.get('lulc')
+        if lulc and lulc['class'] in self.DECISIVE_CLASSES:
+            return f"WorldCover says {lulc['class']}"
+        if results.get('is_urban'):
+            return "OSM confirms urban"
+        return None
+
+    def fetch_all_parallel(self, lat, lon, cancel=None):
+        """
+        Runs the LULC, OSM urban, water and Sentinel-2 fetches concurrently
+        and checks results as they land. Once LULC or OSM urban settles the
+        outcome (see _decisive_result), fetches still queued are cancelled and
+        Sentinel-2 stops before its next band read; calls already in flight
+        run to completion. Setting `cancel` (e.g. on client disconnect)
+        abandons the whole fetch the same way.
+        """
         print(f"📡 Processing Satellite & Urban Pipelines...")
         results = {}
-        # Using 4 workers to handle everything at once
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = {
-                executor.submit(self.fetch_sentinel2_direct, lat, lon): 'sentinel',
-                executor.submit(self.fetch_lulc_direct, lat, lon): 'lulc',
-                executor.submit(self.is_urban_area, lat, lon): 'is_urban',
-                executor.submit(self.fetch_water_osm, lat, lon): 'water_dist'
-            }
-            for future in as_completed(futures):
-                results[futures[future]] = future.result()
-        
+        stop = threading.Event()
+        # Shared, bounded pool (see admission.py) instead of a new pool per request
+        futures = {
+            SHARED_EXECUTOR.submit(attached(self.fetch_lulc_direct), lat, lon): 'lulc',
+            SHARED_EXECUTOR.submit(attached(self.is_urban_area), lat, lon): 'is_urban',
+            SHARED_EXECUTOR.submit(attached(self.fetch_water_osm), lat, lon): 'water_dist',
+            SHARED_EXECUTOR.submit(attached(self.fetch_sentinel2_direct), lat, lon, stop): 'sentinel'
+        }
+        pending = set(futures)
+        decided = None
+        while pending and not decided:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            if cancel is not None and cancel.is_set():
+                print("🔌 Request cancelled. Dropping in-flight fetches.")
+                stop.set()
+                for future in pending: future.cancel()
+                return None
+            try:
+                for future in done:
+                    results[futures[future]] = future.result()
+            except UpstreamBusy:
+                # One upstream is saturated: abandon the rest and let the route shed
+                stop.set()
+                for future in pending: future.cancel()
+                raise
+            decided = self._decisive_result(results)
+
+        if decided:
+            # Built-up / water SSI is multiplied by 0.1 and analyze_site never
+            # promotes a short-circuited site, so the placeholders below can't
+            # lift the score. Don't wait for the rest.
+            print(f"⚡ Short-circuit: {decided}. Skipping {len(pending)} pending fetch(es).")
+            stop.set()
+            for future in pending: future.cancel()
+            results.setdefault('sentinel', {"ndvi": 0.15, "ndwi": 0.0})
+            if not results.get('lulc'):
+                name, soil, suit = self.lulc_map[50]
+                results['lulc'] = {"class": name, "soil_depth": soil, "suitability": suit}
+
         if not results.get('sentinel') or not results.get('lulc'): return None
         
         # Merge results into one dictionary
         combined = {**results['sentinel'], **results['lulc']}
         combined['is_urban'] = results.get('is_urban', False)
         combined['water_dist'] = results.get('water_dist', 3000)
+        combined['short_circuit'] = decided
         return combined
 
     def calculate_ssi(self, data):
@@ -149,8 +241,8 @@ class SiteScouterV2:
         
         return round(ssi, 3), {"lulc": n_lulc, "ndvi": n_ndvi, "water": n_water}
 
-    def analyze_site(self, lat, lon, name="Target"):
-        data = self.fetch_all_parallel(lat, lon)
+    def analyze_site(self, lat, lon, name="Target", cancel=None):
+        data = self.fetch_all_parallel(lat, lon, cancel)
         if not data: 
             print("❌ Data Fetch Failed")
             return None
@@ -163,6 +255,12 @@ class SiteScouterV2:
             print("🏙️  Confirmed Urban Area (No override)")
             data['class'] = "Built-up"
             data['suitability'] = 0.05
+        elif original_class == "Water Bodies":
+            # Open water has low NDVI too; it must never be promoted to "barren"
+            print("🌊 Confirmed Water Body (No override)")
+        elif data.get('short_circuit'):
+            # NDVI / water distance are placeholders here, not measurements
+            print(f"⚡ Decided early ({data['short_circuit']}). No override.")
         elif data['ndvi'] <= 0.16:
             print("🌵 Confirmed Barren/Desert Area (Override Triggered)")
             data['class'] = "Bare/Sparse Vegetation"
@@ -185,6 +283,175 @@ class SiteScouterV2:
 
         return ssi
 
+    # ==========================================
+    # RASTER MODE: Pixel-level SSI for a bounding box
+    # ==========================================
+    def _read_cog_grid(self, href, bbox, width, height, resampling):
+        """
+        Reads only the bbox window of a COG, warped onto a shared
+        EPSG:4326 grid so every layer lines up pixel-for-pixel.
+        """
+        transform = from_bounds_transform(*bbox, width, height)
+        with upstream_limiter.slot("stac"), rasterio.open(href) as src:
+            with WarpedVRT(src, crs="EPSG:4326", transform=transform,
+                           width=width, height=height, resampling=resampling) as vrt:
+                return vrt.read(1)
+
+    def fetch_raster_layers(self, bbox, resolution=0.0001):
+        """
+        One STAC search per collection, then B04, B08 and WorldCover are
+        read in parallel onto a common grid (~10 m at the default resolution).
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        width = max(1, int(np.ceil((max_lon - min_lon) / resolution)))
+        height = max(1, int(np.ceil((max_lat - min_lat) / resolution)))
+
+        s2_items = self._search_items(
+            "sentinel-2-l2a",
+            list(bbox),
+            datetime="2024-01-01/2024-12-31",
+            query={"eo:cloud_cover": {"lt": 25}},
+            max_items=1
+        )
+        lulc_items = self._search_items("esa-worldcover", list(bbox))
+        if not s2_items or not lulc_items: return None
+
+        reads = {
+            "B04": (s2_items[0].assets["B04"].href, Resampling.bilinear),
+            "B08": (s2_items[0].assets["B08"].href, Resampling.bilinear),
+            "lulc": (lulc_items[0].assets["map"].href, Resampling.nearest)  # Categorical!
+        }
+        futures = {
+            SHARED_EXECUTOR.submit(attached(self._read_cog_grid), href, bbox, width, height, method): key
+            for key, (href, method) in reads.items()
+        }
+        layers = {futures[f]: f.result() for f in as_completed(futures)}
+        layers["transform"] = from_bounds_transform(*bbox, width, height)
+        return layers
+
+    def calculate_ssi_raster(self, layers, water_dist=3000, is_urban=False):
+        """
+        Vectorized analyze_site + calculate_ssi (same AHP weights and heat
+        proofing). Water distance and the OSM urban check are single lookups
+        at the bbox centre, not per pixel. The urban check only looks within
+        URBAN_RADIUS_M of the centre, so it marks just those pixels Built-up;
+        elsewhere Built-up comes from WorldCover class 50 alone.
+        """
+        red = layers["B04"].astype(np.float32) / 10000.0
+        nir = layers["B08"].astype(np.float32) / 10000.0
+        lulc = layers["lulc"].astype(np.int64)
+        valid = (layers["B04"] > 0) & (layers["B08"] > 0) & (lulc > 0)
+
+        ndvi = (nir - red) / (nir + red + 1e-8)
+
+        # LULC lookup tables (unknown classes -> soil 50, suitability 0.5)
+        suit_lut = np.full(256, 0.5, dtype=np.float32)
+        soil_lut = np.full(256, 50, dtype=np.float32)
+        for code, (_, soil, suit) in self.lulc_map.items():
+            suit_lut[code], soil_lut[code] = suit, soil
+        n_lulc = suit_lut[lulc]
+        soil_cm = soil_lut[lulc]
+
+        # Same heat proofing as analyze_site: urban stays urban, water is never
+        # promoted, barren gets suitability 1.0 (soil depth keeps its class value)
+        built_up = lulc == 50
+        if is_urban:
+            built_up |= self._near_centre(layers["transform"], lulc.shape, self.URBAN_RADIUS_M)
+        water = ~built_up & (lulc == 80)
+        barren = ~built_up & ~water & (ndvi <= 0.16)
+        n_lulc = np.where(built_up, self.lulc_map[50][2], n_lulc)
+        n_lulc = np.where(barren, 1.0, n_lulc)
+
+        n_ndvi = np.select(
+            [(ndvi >= 0.05) & (ndvi <= 0.20), ndvi < 0.05, ndvi <= 0.40],
+            [1.0, 0.6, 0.4],
+            default=0.1
+        )
+        n_water = 1 / (1 + (water_dist / 2500)**2)
+        n_soil = np.minimum(soil_cm / 100.0, 1.0)
+
+        ssi = (n_lulc * 0.40) + (n_ndvi * 0.30) + (n_water * 0.20) + (n_soil * 0.10)
+        ssi = np.where(built_up | water, ssi * 0.1, ssi)
+        return np.where(valid, ssi, np.nan).astype(np.float32), ndvi
+
+    @staticmethod
+    def _near_centre(transform, shape, radius_m):
+        """Mask of pixels whose centre lies within radius_m of the grid centre."""
+        height, width = shape
+        lons = transform.c + (np.arange(width) + 0.5) * transform.a
+        lats = transform.f + (np.arange(height) + 0.5) * transform.e
+        centre_lon = transform.c + width * transform.a / 2
+        centre_lat = transform.f + height * transform.e / 2
+        # Equirectangular metres: accurate enough across a few-km bbox
+        dx = (lons - centre_lon) * 111320 * np.cos(np.radians(centre_lat))
+        dy = (lats - centre_lat) * 110540
+        return dy[:, None]**2 + dx[None, :]**2 <= radius_m**2
+
+    def analyze_bbox(self, bbox, output="summary", top_k=10, resolution=0.0001):
+        """
+        Scores every pixel in bbox = (min_lon, min_lat, max_lon, max_lat).
+        output="summary" -> stats dict, "geotiff" / "png" -> encoded bytes.
+        """
+        print(f"🗺️  Raster SSI for bbox {bbox}...")
+        centre_lat, centre_lon = (bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2
+        # Centre-point OSM checks run alongside the raster reads
+        water_future = SHARED_EXECUTOR.submit(attached(self.fetch_water_osm), centre_lat, centre_lon)
+        urban_future = SHARED_EXECUTOR.submit(attached(self.is_urban_area), centre_lat, centre_lon)
+        layers = self.fetch_raster_layers(bbox, resolution)
+        if not layers:
+            print("❌ Raster Fetch Failed")
+            return None
+
+        ssi, ndvi = self.calculate_ssi_raster(layers, water_future.result(), urban_future.result())
+        transform = layers["transform"]
+
+        if output == "geotiff":
+            return self._encode_raster(ssi, transform, "GTiff")
+        if output == "png":
+            return self._encode_raster(ssi, transform, "PNG")
+
+        # Pixel area in hectares (degree grid -> metres at the bbox centre)
+        px_w = geodesic((centre_lat, centre_lon), (centre_lat, centre_lon + resolution)).meters
+        px_h = geodesic((centre_lat, centre_lon), (centre_lat + resolution, centre_lon)).meters
+        px_ha = px_w * px_h / 10000.0
+
+        scored = np.nan_to_num(ssi, nan=-1.0)
+        k = min(top_k, int(np.count_nonzero(scored >= 0)))
+        flat_idx = np.argpartition(scored.ravel(), -k)[-k:] if k else np.array([], dtype=int)
+        flat_idx = flat_idx[np.argsort(scored.ravel()[flat_idx])[::-1]]
+        top_pixels = []
+        for row, col in zip(*np.unravel_index(flat_idx, ssi.shape)):
+            lon, lat = transform * (col + 0.5, row + 0.5)
+            top_pixels.append({"lat": round(lat, 6), "lon": round(lon, 6), "ssi": round(float(ssi[row, col]), 3)})
+
+        valid_px = int(np.count_nonzero(~np.isnan(ssi)))
+        return {
+            "bbox": list(bbox),
+            "grid": {"width": ssi.shape[1], "height": ssi.shape[0], "pixel_area_ha": round(px_ha, 4)},
+            "valid_pixels": valid_px,
+            "mean_ssi": round(float(np.nanmean(ssi)), 3) if valid_px else None,
+            "mean_ndvi": round(float(np.nanmean(np.where(np.isnan(ssi), np.nan, ndvi))), 3) if valid_px else None,
+            "high_priority_ha": round(int(np.count_nonzero(scored > 0.75)) * px_ha, 2),
+            "suitable_ha": round(int(np.count_nonzero(scored > 0.50)) * px_ha, 2),
+            "top_pixels": top_pixels
+        }
+
+    def _encode_raster(self, ssi, transform, driver):
+        height, width = ssi.shape
+        if driver == "PNG":
+            # 8-bit preview: SSI 0..1 -> 1..255, 0 = no data
+            data = np.where(np.isnan(ssi), 0, 1 + np.clip(ssi, 0, 1) * 254).astype(np.uint8)
+            profile = {"dtype": "uint8", "nodata": 0}
+        else:
+            data = ssi
+            profile = {"dtype": "float32", "nodata": np.nan, "compress": "deflate"}
+
+        with MemoryFile() as memfile:
+            with memfile.open(driver=driver, width=width, height=height, count=1,
+                              crs="EPSG:4326", transform=transform, **profile) as dst:
+                dst.write(data, 1)
+            return memfile.read()
+
 if __name__ == "__main__":
     scout = SiteScouterV2()
     
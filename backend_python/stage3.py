@@ -2,6 +2,8 @@ import requests
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
+from admission import UpstreamBusy, upstream_limiter
+from singleflight import single_flight, point_key
 
 class EarlyWarningSystem:
     def __init__(self):
@@ -24,10 +26,14 @@ class EarlyWarningSystem:
     def fetch_multi_year_data(self, lat, lon):
         """
         Fetches 3 full years of daily weather data (Temperature & Rain).
+        Concurrent requests for the same site share one download.
         """
         end_date = datetime.now().date() - timedelta(days=2)
         start_date = end_date - timedelta(days=1095) # 3 Years of Data
-        
+        key = ("open_meteo", *point_key(lat, lon), str(start_date), str(end_date))
+        return single_flight.do(key, self._download_archive, lat, lon, start_date, end_date)
+
+    def _download_archive(self, lat, lon, start_date, end_date):
         params = {
             "latitude": lat, "longitude": lon,
             "start_date": start_date, "end_date": end_date,
@@ -35,10 +41,13 @@ class EarlyWarningSystem:
             "timezone": "auto"
         }
         try:
-            response = requests.get(self.api_url, params=params, timeout=15)
+            with upstream_limiter.slot("open_meteo"):
+                response = requests.get(self.api_url, params=params, timeout=15)
             if response.status_code == 200:
                 return response.json().get('daily', {})
             return None
+        except UpstreamBusy:
+            raise  # Shed the request (503) rather than invent data
         except Exception as e:
             print(f"Error fetching weather data: {e}")
             return None
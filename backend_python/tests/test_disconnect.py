@@ -0,0 +1,72 @@
+import asyncio
+import importlib
+import sys
+import threading
+import types
+
+import pytest
+
+
+class FakeScout:
+    """Stands in for SiteScouterV2: blocks until the request's cancel is set."""
+    def __init__(self):
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+
+    def analyze_site(self, lat, lon, name, cancel=None):
+        self.started.set()
+        if cancel is not None and cancel.wait(timeout=5):
+            self.cancelled.set()
+        return None
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # Swap the satellite / GEE engines for fakes so main imports offline
+    engines = {
+        "stage1": {"SiteScouterV2": FakeScout},
+        "stage3": {"EarlyWarningSystem": type("EarlyWarningSystem", (), {"KNOWLEDGE_BASE": {}})},
+        "stage4": {"GEEImpactEngine": type("GEEImpactEngine", (), {"__init__": lambda self, kb: None})},
+        "overlay": {"IndiaOverlayEngine": type("IndiaOverlayEngine", (), {})},
+    }
+    for name, attrs in engines.items():
+        monkeypatch.setitem(sys.modules, name, types.SimpleNamespace(**attrs))
+    monkeypatch.delitem(sys.modules, "main", raising=False)
+    monkeypatch.chdir(tmp_path)  # Profiles land in ./profiles
+    module = importlib.import_module("main")
+    yield module
+    sys.modules.pop("main", None)
+
+
+@pytest.mark.parametrize("profiled", [False, True])
+def test_disconnect_mid_request_sets_cancel(main, monkeypatch, profiled):
+    headers = []
+    if profiled:
+        monkeypatch.setattr("profiling.PROFILE_TOKEN", "token")
+        headers.append((b"x-profile", b"token"))
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": "/analyze/12.9/77.5",
+        "raw_path": b"/analyze/12.9/77.5", "query_string": b"", "root_path": "",
+        "headers": headers, "client": ("testclient", 50000), "server": ("testserver", 80),
+    }
+
+    async def run():
+        inbox = asyncio.Queue()
+        await inbox.put({"type": "http.request", "body": b"", "more_body": False})
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        request = asyncio.create_task(main.app(scope, inbox.get, send))
+        assert await asyncio.to_thread(main.scout.started.wait, 5)
+        await inbox.put({"type": "http.disconnect"})
+        await asyncio.wait_for(request, 5)
+        return sent
+
+    sent = asyncio.run(run())
+    assert main.scout.cancelled.is_set()
+    if profiled:
+        start = next(m for m in sent if m["type"] == "http.response.start")
+        assert any(name == b"x-profile-id" for name, _ in start["headers"])